@@ -1,212 +1,707 @@
 # ai_commander_nmap_allports.py
-import json, os, re, subprocess, sys
-from datetime import datetime
+import asyncio, hashlib, io, os, re, selectors, shlex, signal, ssl, subprocess, sys, time
+import httpx
 import ollama
+import orjson
 
 # ------------ CONFIG ------------
-MODEL = "mistral"
+MODEL = "mistral:7b-instruct-q4_K_M"  # 4-bit weights: far less memory traffic per decoded token
+NUM_CTX = 4096                   # context window requested from the server
 TARGET_IP = "192.168.56.101"          # change if needed
 MAX_STEPS = 10
 TIMEOUT_SEC = 15                 # per follow-on command
+MAX_PARALLEL = 4                 # follow-on commands run concurrently per step
 NMAP_TIMEOUT_SEC = 240           # allow time for full -p- scan
+BANNER_TIMEOUT_SEC = 3           # per-port connect/read budget for the bootstrap banner sweep
+BANNER_CONCURRENCY = 64          # sockets open at once during the sweep (stays well under the fd limit)
 LOG_DIR = "ai_runs"
+CACHE_DIR = ".ai_enum_cache"     # scan results and model replies reused across runs
+CACHE_TTL_SEC = 3600
+HISTORY_WINDOW = 4               # step messages re-sent verbatim; older ones collapse to one line
+# Prompt sizing against NUM_CTX: anything past it is silently dropped from the front (system prompt first)
+CHARS_PER_TOKEN = 3              # conservative chars-per-token estimate for command output
+REPLY_TOKENS = 512               # num_predict for every model reply
+PROMPT_TOKEN_BUDGET = NUM_CTX - REPLY_TOKENS
+STDOUT_LIMIT = PROMPT_TOKEN_BUDGET * CHARS_PER_TOKEN // (5 * MAX_PARALLEL)  # one step's results ~1/5 of context
+STDERR_LIMIT = STDOUT_LIMIT // 4
+SEED_FIELD_LIMIT = PROMPT_TOKEN_BUDGET * CHARS_PER_TOKEN // 8  # each of ports / raw nmap / banners
+DIGEST_LIMIT = 240               # chars per collapsed step line (command text included)
+KEEP_ALIVE = "30m"               # keep model + cached system prefix resident between steps
+# Sent on every call: a different num_ctx between calls would force the server to reload the model
+MODEL_OPTIONS = {"temperature": 0, "num_ctx": NUM_CTX, "num_batch": 512}
 
 # ------------ SAFETY ------------
 DANGEROUS_PATTERNS = re.compile(
-    r"(?:\b(?:rm\s+-rf|rm\s+-fr|mkfs|fdisk|parted|dd\s+if=|:>\s*/|truncate\s+-s|"
-    r"chmod\s+([0-7]{3}|[+-][rwxXstugo]+)\s+-R\s+/|chown\s+-R\s+/|mv\s+/.+|"
+    r"(?:\b(?:rm\s+-rf|rm\s+-fr|mkfs|fdisk|parted|dd\s+if=|truncate\s+-s|"
+    r"chmod\s+(?:[0-7]{3}|[+-][rwxXstugo]+)\s+-R\s+/|chown\s+-R\s+/|mv\s+/.+|"
     r"shutdown\b|reboot\b|poweroff\b|halt\b|swapoff\b|kill\s+-9\s+1\b|mount\s+-o\s+remount[,=]rw\s+/)"
-    r"|:\(\)\s*{\s*:\s*\|\s*:\s*&\s*}\s*;\s*:\s*$)",
+    r"|:>\s*/|:\(\)\s*{\s*:\s*\|\s*:\s*&\s*}\s*;\s*:\s*$)",
     re.IGNORECASE
 )
 
+# Literal substrings at least one of which every DANGEROUS_PATTERNS match contains.
+# Kept whitespace-free so "rm\t-rf"-style spacing still reaches the regex.
+_TRIGGERS = (
+    "rm", "mkfs", "fdisk", "parted", "dd", ":>", "truncate", "chmod", "chown", "mv",
+    "shutdown", "reboot", "poweroff", "halt", "swapoff", "kill", "remount", ":(",
+)
+
+# Hot-path regexes compiled once at import
+_GNMAP_PORTS = re.compile(r"\tPorts: ([^\t\n]*)")
+_JSON_OBJ = re.compile(r"\{.*\}", re.S)
+_FALLBACK_CMD = re.compile(r'(?m)^(?:`+)?([a-zA-Z0-9_-]+(?:\s+[^\n`]+)?)')
+
 def is_safe(cmd: str) -> bool:
     if not cmd or not cmd.strip():
         return False
     if cmd.strip() in {"bash", "sh"}:
         return False
+    # Fast path only for ASCII: IGNORECASE also folds "ſ", "ı", "İ", "K" onto ASCII letters,
+    # which neither lower() nor casefold() fully reproduces, so anything else takes the regex
+    if cmd.isascii() and not any(t in cmd.casefold() for t in _TRIGGERS):
+        return True
     return not bool(DANGEROUS_PATTERNS.search(cmd))
 
-def run_cmd(cmd: str, timeout: int):
-    return subprocess.run(
-        ["bash", "-lc", cmd],
-        capture_output=True,
-        text=True,
-        timeout=timeout
+# Action objects carry model-chosen text too (e.g. a banner "send" payload); hold it to the same policy
+def action_is_safe(item) -> bool:
+    return not any(
+        isinstance(v, str) and DANGEROUS_PATTERNS.search(v)
+        for k, v in item.items() if k != "action"
+    )
+
+# Characters that need a real shell (pipes, redirects, expansion, globbing, comments)
+SHELL_META = "|&;<>$`(){}*?[~#\n"
+# Bash builtins and keywords (`compgen -b -k`): exec'ing these fails or runs a different /usr/bin copy
+SHELL_BUILTINS = frozenset("""
+    . : [ [[ ! alias bg bind break builtin caller case cd command compgen complete compopt continue
+    coproc declare dirs disown do done echo elif else enable esac eval exec exit export false fc fg
+    fi for function getopts hash help history if in jobs kill let local logout mapfile popd printf
+    pushd pwd read readarray readonly return select set shift shopt source suspend test then time
+    times trap true type typeset ulimit umask unalias unset until wait while
+""".split())
+ASSIGNMENT = re.compile(r"[A-Za-z_][A-Za-z0-9_]*=")
+
+def command_argv(cmd: str):
+    if not any(c in cmd for c in SHELL_META):
+        try:
+            toks = shlex.split(cmd)
+        except ValueError:
+            toks = []
+        # FOO=1 curl ... sets an env var, cd/export/... only exist inside a shell
+        if toks and toks[0] not in SHELL_BUILTINS and not ASSIGNMENT.match(toks[0]):
+            return toks  # plain argv: exec directly, no shell
+    return ["bash", "-c", cmd]  # non-login shell: skips profile scripts
+
+async def run_cmd(cmd: str, timeout: int):
+    proc = await asyncio.create_subprocess_exec(
+        *command_argv(cmd),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,  # own process group, so a timeout reaches every stage of a pipeline
+    )
+    try:
+        out, err = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        return None, b"", f"Timeout after {timeout}s"
+    finally:
+        # Timeout, Ctrl-C or cancellation: don't leave any stage of the group running
+        if proc.returncode is None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await asyncio.shield(proc.wait())
+    return proc.returncode, out, err
+
+async def execute(cmd: str):
+    try:
+        rc, out, err = await run_cmd(cmd, timeout=TIMEOUT_SEC)
+    except Exception as e:
+        rc, out, err = None, b"", f"Execution error: {e}"
+    return {
+        "executed_command": cmd,
+        "returncode": rc,
+        "stdout": truncate(out, STDOUT_LIMIT),
+        "stderr": truncate(err, STDERR_LIMIT),
+    }
+
+# In-process equivalent of "echo | nc -w 3 HOST PORT": connect, send a newline, read what comes back.
+# Connect failures raise (refused vs. filtered matters); a connected but silent port returns b"".
+async def read_banner(host: str, port: int, probe: bytes = b"\n", timeout: float = BANNER_TIMEOUT_SEC) -> bytes:
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"connect to {host}:{port} timed out after {timeout}s") from None
+    try:
+        if probe:
+            writer.write(probe)
+            await writer.drain()
+        return await asyncio.wait_for(reader.read(4096), timeout)
+    except asyncio.TimeoutError:
+        return b""
+    finally:
+        writer.close()
+
+# Bootstrap sweep variant: any failure just means "no banner"
+async def grab_banner(host: str, port: int) -> bytes:
+    try:
+        return await read_banner(host, port)
+    except OSError:
+        return b""
+
+# Grab banners concurrently on the event loop (no per-port nc fork/exec), BANNER_CONCURRENCY
+# ports per batch so thousands of "open" ports can't exhaust file descriptors. Stops once the
+# banners fill the tcp_banners seed field; later ports would be cut from the prompt anyway
+async def tcp_banner_scan(host: str, ports) -> dict:
+    banners = {}
+    for i in range(0, len(ports), BANNER_CONCURRENCY):
+        batch = ports[i:i + BANNER_CONCURRENCY]
+        grabbed = await asyncio.gather(*(grab_banner(host, port) for port in batch))
+        banners.update((str(port), truncate(b, 512)) for port, b in zip(batch, grabbed) if b)
+        if len(orjson.dumps(banners)) >= SEED_FIELD_LIMIT:
+            break
+    return banners
+
+# ------------ IN-PROCESS ACTIONS ------------
+# Structured probes the model can request instead of shelling out to curl/openssl/nc
+async def action_http_head(http, host, port, item):
+    scheme = item.get("scheme") or ("https" if port in (443, 8443) else "http")
+    r = await http.head(f"{scheme}://{host}:{port}/")
+    lines = [f"{r.http_version} {r.status_code} {r.reason_phrase}"]
+    lines += [f"{k}: {v}" for k, v in r.headers.items()]
+    return 0, "\n".join(lines)
+
+async def action_tls_peek(http, host, port, item):
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE  # lab targets are usually self-signed; we only want to look
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port, ssl=ctx, server_hostname=host), TIMEOUT_SEC
     )
+    try:
+        tls = writer.get_extra_info("ssl_object")
+        der = tls.getpeercert(binary_form=True) or b""
+        lines = [
+            f"protocol: {tls.version()}",
+            f"cipher: {tls.cipher()[0]}",
+            f"alpn: {tls.selected_alpn_protocol()}",
+            f"cert_sha256: {hashlib.sha256(der).hexdigest()}",
+            ssl.DER_cert_to_PEM_cert(der) if der else "no certificate",
+        ]
+    finally:
+        writer.close()
+    return 0, "\n".join(lines)
+
+async def action_banner(http, host, port, item):
+    send = item.get("send", "\n")
+    return 0, await read_banner(host, port, send.encode(), timeout=TIMEOUT_SEC)
+
+ACTIONS = {
+    "http_head": action_http_head,
+    "tls_peek": action_tls_peek,
+    "banner": action_banner,
+}
+
+async def run_action(http, item):
+    host = str(item.get("host") or TARGET_IP)
+    label = f"{item['action']} {host}:{item.get('port')}"
+    try:
+        rc, out = await ACTIONS[item["action"]](http, host, int(item.get("port")), item)
+        err = ""
+    except Exception as e:
+        rc, out, err = None, "", f"Execution error: {e}"
+    return {
+        "executed_command": label,
+        "returncode": rc,
+        "stdout": truncate(out, STDOUT_LIMIT),
+        "stderr": truncate(err, STDERR_LIMIT),
+    }
 
 def ensure_logdir():
-    os.makedirs(LOG_DIR, exist_ok=True)
-    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    run_dir = os.path.join(LOG_DIR, f"run_{stamp}")
-    os.makedirs(run_dir, exist_ok=True)
-    return run_dir
+    stamp = time.strftime("%Y%m%d_%H%M%S")
+    run_dir = f"{LOG_DIR}/run_{stamp}"
+    os.makedirs(run_dir, exist_ok=True)  # creates LOG_DIR too
+    events = open(os.path.join(run_dir, "events.jsonl"), "ab", buffering=1 << 16)
+    return run_dir, events
+
+# One JSON line per event in a single append-only file, instead of a file per step
+def log_event(events, kind, step, payload):
+    events.write(orjson.dumps({"t": time.time(), "kind": kind, "step": step, "data": payload}) + b"\n")
+
+# ------------ CACHE ------------
+def cache_load(path):
+    try:
+        if os.path.getmtime(path) <= time.time() - CACHE_TTL_SEC:
+            return None
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+def cache_store(path, payload):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(payload))
+    os.replace(tmp, path)  # readers never see a half-written entry
+
+# Drop expired entries; the TTL check in cache_load alone would let the directory grow forever
+def cache_prune(directory):
+    cutoff = time.time() - CACHE_TTL_SEC
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime <= cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
 
+# Standalone, human-read files only (final_summary.json); machine logs go through log_event unindented
 def write_json(path, payload):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(payload, f, indent=2, ensure_ascii=False)
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(payload, option=orjson.OPT_INDENT_2))
 
-def truncate(s, limit=8000):
-    if s is None:
+# Command output stays as bytes so only the kept prefix is ever decoded
+def truncate(b, limit=8000):
+    if not b:
         return ""
-    return s if len(s) <= limit else s[:limit] + "…[truncated]"
+    if isinstance(b, str):
+        return b if len(b) <= limit else b[:limit] + "…[truncated]"
+    return b[:limit].decode("utf-8", "replace") + ("…[truncated]" if len(b) > limit else "")
 
-# Parse normal nmap output lines like: "22/tcp open  ssh"
-def parse_nmap_text(stdout: str):
+# Parse one grepable nmap line like:
+# "Host: 10.0.0.5 ()\tPorts: 22/open/tcp//ssh///, 80/open/tcp//http///\tIgnored State: closed (65533)"
+def parse_nmap_grepable(line: str):
+    m = _GNMAP_PORTS.search(line)
+    if not m:
+        return []
     open_ports = []
-    for line in stdout.splitlines():
-        line = line.strip()
-        m = re.match(r"^(\d+)\/(tcp|udp)\s+open\s+(\S+)", line)
-        if m:
-            port = int(m.group(1))
-            proto = m.group(2)
-            service = m.group(3)
-            open_ports.append({"port": port, "proto": proto, "service": service})
+    for entry in m.group(1).split(", "):
+        fields = entry.split("/")
+        if len(fields) >= 5 and fields[1] == "open":
+            open_ports.append({"port": int(fields[0]), "proto": fields[2], "service": fields[4] or "unknown"})
     return open_ports
 
+# Run nmap with "-oG -", draining stdout/stderr together and parsing Ports: lines as they arrive
+def run_nmap_grepable(argv, timeout: int):
+    try:
+        proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        return None, [], "", f"Execution error: {e}"
+    bufs = {proc.stdout: io.BytesIO(), proc.stderr: io.BytesIO()}
+    open_ports, pending, timed_out = [], b"", False
+    deadline = time.monotonic() + timeout
+    with selectors.DefaultSelector() as sel:
+        for f in bufs:
+            sel.register(f, selectors.EVENT_READ)
+        while sel.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                timed_out = True
+                proc.kill()
+                proc.wait()
+                for key in list(sel.get_map().values()):
+                    os.set_blocking(key.fd, False)  # a surviving grandchild may still hold the pipe
+                    bufs[key.fileobj].write(key.fileobj.read() or b"")
+                break
+            for key, _ in sel.select(timeout=remaining):
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    sel.unregister(key.fileobj)
+                    continue
+                bufs[key.fileobj].write(chunk)
+                if key.fileobj is proc.stdout:
+                    *lines, pending = (pending + chunk).split(b"\n")
+                    for line in lines:
+                        if b"\tPorts: " in line:
+                            open_ports.extend(parse_nmap_grepable(line.decode("utf-8", "replace")))
+    if b"\tPorts: " in pending:
+        open_ports.extend(parse_nmap_grepable(pending.decode("utf-8", "replace")))
+    rc = proc.wait()
+    proc.stdout.close()
+    proc.stderr.close()
+    out = bufs[proc.stdout].getvalue().decode("utf-8", "replace")
+    err = bufs[proc.stderr].getvalue().decode("utf-8", "replace")
+    if timed_out:
+        rc, err = None, f"Timeout after {timeout}s"
+    return rc, open_ports, out, err
+
 # ------------ PROMPTS ------------
-SYSTEM_PROMPT = f"""
-You are a *non-destructive* lab assistant. We've already run "nmap -p- TARGET_IP" and will give you:
-1) a compact JSON list of open ports/services (parsed from the text output),
-2) the raw nmap stdout (possibly truncated).
+# Service-independent part; also what the warmup prefills, since every specialized prompt starts with it
+BASE_PROMPT = f"""
+You are a *non-destructive* lab assistant. We've already run "nmap -oG - -p- TARGET_IP" and will give you:
+1) a compact JSON list of open ports/services (parsed from the grepable output),
+2) the raw grepable nmap stdout (possibly truncated),
+3) the banner each open TCP port returned to a bare newline (empty ports omitted).
 
-Using that, propose exactly ONE safe, quick shell command to enumerate the most promising service next.
+Using that, propose up to {MAX_PARALLEL} safe, quick commands (action objects or shell) to enumerate the most promising services next.
+They run concurrently, so make them independent (ideally one per service).
 Return STRICT JSON only:
 {{
   "thoughts": "brief reasoning",
-  "command": "single shell command to run next, or empty if none",
-  "explanation": "1-2 sentence why this command helps",
+  "commands": ["shell command or action object", "..."],
+  "explanation": "1-2 sentence why these commands help",
   "done": false
 }}
 
 Rules:
 - Non-destructive only. No writes to system files, no privilege escalation, no service disruption.
-- Prefer quick, bounded flags/timeouts (e.g., curl -I -m 5, openssl s_client -connect HOST:PORT </dev/null | head -n 40).
-- Tailor to service:
-  - HTTP(S): curl -I -m 5 http://HOST:PORT or https://HOST:PORT
-  - TLS generic: openssl s_client -connect HOST:PORT -servername HOST </dev/null | head -n 40
-  - SSH: ssh -o BatchMode=yes -o ConnectTimeout=5 -G HOST | head -n 20  (non-interactive)
-  - FTP: echo QUIT | nc -v -w 3 HOST 21
-  - SMTP: echo -e "EHLO test\\r\\nQUIT\\r\\n" | nc -v -w 5 HOST 25
-  - MySQL: echo | nc -v -w 3 HOST 3306  (banner peek)
-  - Postgres: echo | nc -v -w 3 HOST 5432
-  - Redis: echo -e "PING\\r\\n" | nc -v -w 3 HOST 6379
-  - Generic TCP: echo | nc -v -w 3 HOST PORT
+- Prefer quick, bounded probes; shell commands need explicit timeouts (e.g., ssh -o ConnectTimeout=5, nmap --host-timeout 60s).
+- Prefer an action object over the equivalent shell probe; actions run in-process and are faster:
+  - {{"action": "http_head", "host": HOST, "port": PORT, "scheme": "http" or "https"}}  (instead of curl -I)
+  - {{"action": "tls_peek", "host": HOST, "port": PORT}}  (protocol, cipher, certificate; instead of openssl s_client)
+  - {{"action": "banner", "host": HOST, "port": PORT, "send": "text to send"}}  (instead of echo ... | nc)
 - If nothing else is useful, set "done": true and give a short summary.
 Target IP is {TARGET_IP}.
+Tailor to service:
 """
 
-GOAL = "Plan the safest, most informative single next command based on the nmap -p- results."
+# One line per service family; only the families nmap actually found go into the prompt
+SERVICE_HINTS = {
+    "http": '  - HTTP(S): {"action": "http_head", "host": HOST, "port": PORT, "scheme": "http" or "https"}',
+    "tls": '  - TLS generic: {"action": "tls_peek", "host": HOST, "port": PORT}',
+    "ssh": "  - SSH: ssh -o BatchMode=yes -o ConnectTimeout=5 -G HOST | head -n 20  (non-interactive)",
+    "ftp": '  - FTP: {"action": "banner", "host": HOST, "port": 21, "send": "QUIT\\r\\n"}',
+    "smtp": '  - SMTP: {"action": "banner", "host": HOST, "port": 25, "send": "EHLO test\\r\\nQUIT\\r\\n"}',
+    "mysql": '  - MySQL: {"action": "banner", "host": HOST, "port": 3306, "send": ""}  (server greeting)',
+    "postgresql": '  - Postgres: {"action": "banner", "host": HOST, "port": 5432}',
+    "redis": '  - Redis: {"action": "banner", "host": HOST, "port": 6379, "send": "PING\\r\\n"}',
+}
+GENERIC_HINT = '  - Generic TCP: {"action": "banner", "host": HOST, "port": PORT}  (only if tcp_banners lacks that port)'
+
+# nmap service names that map onto hint families other than their own name
+SERVICE_HINT_ALIASES = {
+    "https": ("http", "tls"),
+    "https-alt": ("http", "tls"),
+    "http-alt": ("http",),
+    "http-proxy": ("http",),
+    "smtps": ("smtp", "tls"),
+    "submission": ("smtp",),
+    "ftps": ("ftp", "tls"),
+    "imaps": ("tls",),
+    "pop3s": ("tls",),
+    "postgres": ("postgresql",),
+}
+
+def build_system_prompt(open_ports):
+    families = set()
+    for p in open_ports:
+        service = p["service"].lower()
+        if service.startswith("ssl"):  # e.g. "ssl|http" when nmap saw TLS in front of the service
+            families.add("tls")
+            service = service[4:]
+        families.update(SERVICE_HINT_ALIASES.get(service, (service,)))
+    hints = [hint for family, hint in SERVICE_HINTS.items() if family in families]
+    return BASE_PROMPT + "\n".join(hints + [GENERIC_HINT]) + "\n"
+
+GOAL = "Plan the safest, most informative next commands based on the nmap -p- results."
 
 def parse_model_json(content: str):
-    try:
-        return json.loads(content)
-    except json.JSONDecodeError:
-        pass
-    m = re.search(r"\{.*\}", content, flags=re.S)
+    stripped = content.lstrip()
+    if stripped.startswith("{"):  # prose-first replies skip a doomed full parse
+        try:
+            return orjson.loads(stripped)
+        except orjson.JSONDecodeError:
+            pass
+    m = _JSON_OBJ.search(content)
     if m:
-        return json.loads(m.group(0))
-    m = re.search(r'(?m)^(?:`+)?([a-zA-Z0-9_-]+(?:\s+[^\n`]+)?)', content)
+        return orjson.loads(m.group(0))
+    m = _FALLBACK_CMD.search(content)
     if m:
-        return {"thoughts": "fallback parse", "command": m.group(1), "explanation": "", "done": False}
+        return {"thoughts": "fallback parse", "commands": [m.group(1)], "explanation": "", "done": False}
     raise ValueError("Strict JSON not found")
 
+# Accept "commands": [...], a single "command": "...", or a bare action object.
+# Shell commands come back as stripped strings, known actions as their dicts.
+def is_action(item):
+    return isinstance(item, dict) and isinstance(item.get("action"), str) and item["action"] in ACTIONS
+
+def model_commands(j):
+    if is_action(j):
+        return [j]
+    cmds = j.get("commands")
+    if cmds is None:
+        cmds = [j.get("command")]
+    if isinstance(cmds, (str, dict)):
+        cmds = [cmds]
+    elif not isinstance(cmds, list):
+        cmds = []  # e.g. "commands": 5 or true
+    out = []
+    for c in cmds:
+        if is_action(c):
+            out.append(c)
+        elif isinstance(c, str) and c.strip():
+            out.append(c.strip())
+    return out[:MAX_PARALLEL]
+
+# Outcome fields only, so e.g. "Connection refused" from different ports/commands collapses
+DEDUPE_FIELDS = ("returncode", "stdout", "stderr", "error")
+
+# Replace results whose outcome matches one from the last few steps with a back-reference
+# that still names the command. The lookback is bounded by HISTORY_WINDOW so the referenced
+# step is recent (verbatim, or at least its digest, is still in the prompt).
+def dedupe_results(results, step, seen_hashes):
+    out = []
+    for r in results:
+        outcome = {k: r[k] for k in DEDUPE_FIELDS if k in r}
+        h = hashlib.blake2b(orjson.dumps(outcome, option=orjson.OPT_SORT_KEYS), digest_size=8).hexdigest()
+        prev = seen_hashes.get(h)
+        if prev is not None and step - prev < HISTORY_WINDOW:
+            ref = {"same_as_step": prev}
+            for key in ("executed_command", "blocked_command"):
+                if key in r:
+                    ref[key] = r[key]
+            out.append(ref)
+        else:
+            seen_hashes[h] = step
+            out.append(r)
+    return out
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def render_prompt(messages):
+    return "\n\n".join(m["content"] for m in messages)
+
+# Keep the seed messages and up to HISTORY_WINDOW recent step messages verbatim, as many as
+# fit PROMPT_TOKEN_BUDGET; older steps are replaced by their one-line digests, and the oldest
+# digests are dropped when even those don't fit
+def window_messages(messages, digests):
+    seed_len = len(messages) - len(digests)
+    seed = messages[:seed_len]
+    for keep in range(min(HISTORY_WINDOW, len(digests)), -1, -1):
+        recent = messages[len(messages) - keep:] if keep else []
+        older = digests[:len(digests) - keep]
+        for drop in range(len(older) + 1):
+            window = seed + digest_message(older[drop:], drop) + recent
+            if estimate_tokens(render_prompt(window)) <= PROMPT_TOKEN_BUDGET:
+                return window
+    # Seed alone is over budget: cut its longest user field until it fits (the system prompt stays whole)
+    window = seed + digest_message([], len(digests))
+    while (excess := estimate_tokens(render_prompt(window)) - PROMPT_TOKEN_BUDGET) > 0:
+        i = max(range(1, len(window)), key=lambda j: len(window[j]["content"]))
+        content = window[i]["content"]
+        if len(content) <= 32:
+            raise ValueError("system prompt alone exceeds PROMPT_TOKEN_BUDGET")
+        window[i] = {**window[i], "content": content[:max(len(content) - excess * CHARS_PER_TOKEN - 16, 16)] + "…[truncated]"}
+    return window
+
+def digest_message(digests, dropped):
+    lines = ([f"({dropped} earlier steps omitted)"] if dropped else []) + digests
+    return [{"role": "user", "content": "earlier_steps_summary:\n" + "\n".join(lines)}] if lines else []
+
+# One capped line per step for earlier_steps_summary
+def step_digest(step, results):
+    notes = []
+    for r in results:
+        if "blocked_command" in r:
+            notes.append(f"blocked by policy: {r['blocked_command'][:60]}")
+        else:
+            stdout_head = r["stdout"][:60].replace("\n", " ")
+            notes.append(f"`{r['executed_command'][:60]}` rc={r['returncode']} stdout: {stdout_head}")
+    return truncate(f"step {step}: " + " | ".join(notes), DIGEST_LIMIT)
+
+# Reuse the server context only while it plus the pending text still fits the budget;
+# otherwise start over from the windowed history with no context
+def next_prompt(messages, digests, context, sent, extra=""):
+    if context is not None:
+        pending = "\n\n".join(filter(None, [render_prompt(messages[sent:]), extra]))
+        if len(context) + estimate_tokens(pending) <= PROMPT_TOKEN_BUDGET:
+            return pending, context
+    window = window_messages(messages, digests)
+    if extra:
+        window = window + [{"role": "user", "content": extra}]
+    return render_prompt(window), None
+
+# One model turn continuing from the previous turn's token context (the server's cached KV
+# state). format="json" makes decoding end when the object closes, so the reply, and with
+# it the returned context, comes back complete without decoding trailing commentary.
+async def generate(client, prompt, context, json_reply=True):
+    if json_reply:
+        fmt, options = "json", {**MODEL_OPTIONS, "num_predict": REPLY_TOKENS, "stop": ["\n\n\n"]}
+    else:
+        fmt, options = None, {**MODEL_OPTIONS, "num_predict": REPLY_TOKENS}
+    # Same model, prompt, context and options at temperature 0 give the same reply
+    key = hashlib.blake2b(orjson.dumps([MODEL, prompt, context, fmt, options]), digest_size=16).hexdigest()
+    cache_path = f"{CACHE_DIR}/llm/{key}.json"
+    cached = cache_load(cache_path)
+    if cached is not None:
+        return cached["response"], cached["context"]
+    if not model_ready:
+        await prepare_model(client, warmup=False)  # this call loads the model anyway
+    resp = await client.generate(
+        model=MODEL,
+        prompt=prompt,
+        context=context,
+        format=fmt,
+        options=options,
+        keep_alive=KEEP_ALIVE,
+    )
+    response, new_context = resp.get("response", ""), list(resp.get("context") or [])
+    cache_store(cache_path, {"response": response, "context": new_context})
+    return response, new_context
+
 # ------------ MAIN ------------
-def main():
-    run_dir = ensure_logdir()
+model_ready = False  # set by prepare_model; a run replayed from the reply cache never needs the server
 
-    # 0) FIRST COMMAND: exactly "nmap -p- <TARGET_IP>"
-    nmap_cmd = f"nmap -p- {TARGET_IP}"
-    print(f"[Bootstrap] Running first command exactly: {nmap_cmd}")
+# Pull the model only if the server doesn't have it, then prefill the system prompt
+# so every later step hits the server's prefix cache
+async def prepare_model(client, warmup=True):
+    global model_ready
     try:
-        proc = run_cmd(nmap_cmd, timeout=NMAP_TIMEOUT_SEC)
-        nmap_rc, nmap_out, nmap_err = proc.returncode, proc.stdout, proc.stderr
-    except subprocess.TimeoutExpired:
-        nmap_rc, nmap_out, nmap_err = None, "", f"Timeout after {NMAP_TIMEOUT_SEC}s"
+        await client.show(MODEL)
+    except ollama.ResponseError as e:
+        if e.status_code != 404:
+            raise
+        await client.pull(MODEL)
+    if warmup:
+        await client.generate(
+            model=MODEL,
+            prompt=BASE_PROMPT,
+            options={**MODEL_OPTIONS, "num_predict": 1},
+            keep_alive=KEEP_ALIVE,
+        )
+    model_ready = True
+
+async def final_summary(client, run_dir, events, messages, digests, context, sent, prompt):
+    prompt, context = next_prompt(messages, digests, context, sent, extra=prompt)
+    final_text, _ = await generate(client, prompt, context, json_reply=False)
+    final_text = final_text.strip()
+    log_event(events, "final_summary", None, final_text)
+    write_json(os.path.join(run_dir, "final_summary.json"), {"final_summary": final_text})
+    print("\n=== FINAL SUMMARY ===\n" + final_text)
+    print(f"\nLogs saved to: {run_dir}")
+
+async def enumerate_target(run_dir, events, http):
+    client = ollama.AsyncClient()
+    cache_prune(f"{CACHE_DIR}/llm")
+
+    # 0) FIRST COMMAND: "nmap -oG - -p- <TARGET_IP>" (grepable output, parsed as it streams)
+    nmap_argv = ["nmap", "-oG", "-", "-p-", TARGET_IP]
+    nmap_cmd = " ".join(nmap_argv)
+    nmap_cache_path = f"{CACHE_DIR}/{TARGET_IP}.json"
+    cached = cache_load(nmap_cache_path)
+    from_cache = cached is not None and cached.get("argv") == nmap_argv
+    if from_cache:
+        scanned_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(cached["ts"]))
+        print(f"[Bootstrap] Reusing cached result of {nmap_cmd} from {scanned_at}")
+        warm_error = None  # model is prepared lazily, on the first reply-cache miss
+        nmap_rc, open_ports, nmap_out, nmap_err = 0, cached["open_ports"], cached["raw_head"], ""
+    else:
+        print(f"[Bootstrap] Running first command: {nmap_cmd}")
+        # Pull and warm the model while nmap runs; a model failure must not discard the scan
+        warm_error, scan = await asyncio.gather(
+            prepare_model(client),
+            asyncio.to_thread(run_nmap_grepable, nmap_argv, NMAP_TIMEOUT_SEC),
+            return_exceptions=True,
+        )
+        if isinstance(scan, BaseException):
+            raise scan
+        nmap_rc, open_ports, nmap_out, nmap_err = scan
+        # nmap also exits 0 for "0 hosts up"; don't let a transient outage stick for CACHE_TTL_SEC
+        if nmap_rc == 0 and (open_ports or "\tStatus: Up" in nmap_out):
+            cache_store(nmap_cache_path, {
+                "argv": nmap_argv,
+                "open_ports": open_ports,
+                "raw_head": nmap_out[:40000],
+                "ts": time.time(),
+            })
 
-    open_ports = parse_nmap_text(nmap_out)
     bootstrap_record = {
         "command": nmap_cmd,
         "returncode": nmap_rc,
-        "stdout": truncate(nmap_out, 120000),
+        "cached": from_cache,
         "stderr": truncate(nmap_err, 20000),
         "parsed_open": open_ports
     }
-    write_json(os.path.join(run_dir, "step_00_nmap_allports.json"), bootstrap_record)
+    log_event(events, "nmap", 0, bootstrap_record)
+    if isinstance(warm_error, BaseException):
+        raise warm_error  # scan is already logged (and cached) by now
+
+    tcp_ports = [p["port"] for p in open_ports if p["proto"] == "tcp"]
+    tcp_banners = await tcp_banner_scan(TARGET_IP, tcp_ports)
+    log_event(events, "banners", 0, tcp_banners)
 
     # Seed the conversation
     messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": f"open_ports_summary: {json.dumps(open_ports)}"},
-        {"role": "user", "content": f"raw_nmap_stdout_truncated:\n{truncate(nmap_out, 40000)}"},
+        {"role": "system", "content": build_system_prompt(open_ports)},
+        {"role": "user", "content": f"open_ports_summary: {truncate(orjson.dumps(open_ports), SEED_FIELD_LIMIT)}"},
+        {"role": "user", "content": f"raw_nmap_grepable_truncated:\n{truncate(nmap_out, SEED_FIELD_LIMIT)}"},
+        {"role": "user", "content": f"tcp_banners: {truncate(orjson.dumps(tcp_banners), SEED_FIELD_LIMIT)}"},
         {"role": "user", "content": GOAL},
     ]
+    digests = []  # one line per step message appended after the seed
+    context, sent = None, 0  # server token context and how many messages it already covers
+    seen_hashes = {}  # result hash -> step it was last sent in full
 
     # 1) Iterative loop based on what nmap found
     for step in range(1, MAX_STEPS + 1):
-        resp = ollama.chat(model=MODEL, messages=messages, options={"temperature": 0})
-        content = resp.get("message", {}).get("content", "")
-        write_json(os.path.join(run_dir, f"step_{step:02d}_assistant_raw.json"), {"assistant_raw": content})
+        prompt, context = next_prompt(messages, digests, context, sent)
+        content, context = await generate(client, prompt, context)
+        sent = len(messages)
+        log_event(events, "assistant_raw", step, content)
 
         try:
             j = parse_model_json(content)
         except Exception as e:
             messages.append({"role": "user", "content": f"Parser error: {e}. Please reply with strict JSON only."})
+            digests.append(f"step {step}: reply was not valid JSON")
             continue
 
-        command = (j.get("command") or "").strip()
+        commands = model_commands(j)
         done = bool(j.get("done", False))
-        write_json(os.path.join(run_dir, f"step_{step:02d}_assistant.json"), j)
+        log_event(events, "assistant", step, j)
 
-        if done or not command:
+        if done or not commands:
             print(f"[Step {step}] Assistant indicated done.")
-            messages.append({"role": "user", "content": "Provide a concise final summary of findings and suggested manual next steps."})
-            final = ollama.chat(model=MODEL, messages=messages, options={"temperature": 0})
-            final_text = final.get("message", {}).get("content", "").strip()
-            write_json(os.path.join(run_dir, "final_summary.json"), {"final_summary": final_text})
-            print("\n=== FINAL SUMMARY ===\n" + final_text)
-            print(f"\nLogs saved to: {run_dir}")
+            await final_summary(client, run_dir, events, messages, digests, context, sent,
+                                "Provide a concise final summary of findings and suggested manual next steps.")
             return
 
-        if not is_safe(command):
+        safe_cmds, actions, results = [], [], []
+        for command in commands:
+            if isinstance(command, dict):
+                if action_is_safe(command):
+                    actions.append(command)
+                    continue
+                command = orjson.dumps(command).decode()  # reported like a blocked shell command
+            elif is_safe(command):
+                safe_cmds.append(command)
+                continue
             print(f"[Step {step}] BLOCKED (unsafe): {command}")
-            feedback = {
-                "result": {
-                    "error": "blocked_by_policy",
-                    "message": "Command blocked by policy. Propose a safe, quick alternative.",
-                    "blocked_command": command
-                }
-            }
-            messages.append({"role": "user", "content": json.dumps(feedback)})
-            write_json(os.path.join(run_dir, f"step_{step:02d}_blocked.json"), feedback)
-            continue
-
-        print(f"[Step {step}] Running: {command}")
-        try:
-            proc = run_cmd(command, timeout=TIMEOUT_SEC)
-            rc, out, err = proc.returncode, proc.stdout, proc.stderr
-        except subprocess.TimeoutExpired:
-            rc, out, err = None, "", f"Timeout after {TIMEOUT_SEC}s"
-        except Exception as e:
-            rc, out, err = None, "", f"Execution error: {e}"
+            results.append({
+                "error": "blocked_by_policy",
+                "message": "Command blocked by policy. Propose a safe, quick alternative.",
+                "blocked_command": command
+            })
 
-        result_for_model = {
-            "executed_command": command,
-            "returncode": rc,
-            "stdout": truncate(out),
-            "stderr": truncate(err),
-        }
-        write_json(os.path.join(run_dir, f"step_{step:02d}_result.json"), result_for_model)
+        for command in safe_cmds:
+            print(f"[Step {step}] Running: {command}")
+        for item in actions:
+            print(f"[Step {step}] Action: {item['action']} {item.get('host') or TARGET_IP}:{item.get('port')}")
+        results.extend(await asyncio.gather(
+            *(execute(c) for c in safe_cmds),
+            *(run_action(http, a) for a in actions),
+        ))
+        log_event(events, "result", step, results)
 
-        messages.append({"role": "user", "content": json.dumps({"result": result_for_model}, ensure_ascii=False)})
+        deduped = dedupe_results(results, step, seen_hashes)
+        messages.append({"role": "user", "content": orjson.dumps({"step": step, "results": deduped}).decode()})
+        digests.append(step_digest(step, results))
 
     # MAX_STEPS reached
-    messages.append({"role": "user", "content": "Max step limit reached. Provide a concise summary of findings so far."})
-    final = ollama.chat(model=MODEL, messages=messages, options={"temperature": 0})
-    final_text = final.get("message", {}).get("content", "").strip()
-    write_json(os.path.join(run_dir, "final_summary.json"), {"final_summary": final_text})
-    print("\n=== FINAL SUMMARY ===\n" + final_text)
-    print(f"\nLogs saved to: {run_dir}")
+    await final_summary(client, run_dir, events, messages, digests, context, sent,
+                        "Max step limit reached. Provide a concise summary of findings so far.")
+
+async def main():
+    run_dir, events = ensure_logdir()
+    with events:
+        # One pooled client for the whole run so repeated HTTP probes reuse connections
+        async with httpx.AsyncClient(http2=True, verify=False, timeout=TIMEOUT_SEC) as http:
+            await enumerate_target(run_dir, events, http)
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
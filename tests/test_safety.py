@@ -0,0 +1,55 @@
+# Invariant: anything DANGEROUS_PATTERNS matches must be rejected by is_safe, including the
+# spellings only the regex catches (tab spacing, case, IGNORECASE folds like "ſ" -> "s").
+# Run with pytest, or directly: python tests/test_safety.py
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from AI_Enumeration import DANGEROUS_PATTERNS, is_safe
+
+# One sample per regex alternative
+SAMPLES = [
+    "rm -rf /tmp/x", "rm -fr /tmp/x", "mkfs /dev/sdb", "fdisk /dev/sda", "parted /dev/sda",
+    "dd if=/dev/zero of=/dev/sda", ":> /etc/passwd", "truncate -s 0 /var/log/x",
+    "chmod 777 -R /", "chmod +x -R /", "chown -R / x", "mv /etc /tmp", "shutdown now", "reboot",
+    "poweroff", "halt", "swapoff -a", "kill -9 1", "mount -o remount,rw /", ":(){ :|:& };:",
+]
+
+# Non-ASCII characters that re.IGNORECASE folds onto ASCII letters
+FOLDS = {"s": "ſ", "i": "ıİ", "k": "K"}
+
+def variants(cmd):
+    yield cmd
+    yield cmd.upper()
+    yield cmd.replace(" ", "\t")
+    for ascii_char, folded in FOLDS.items():
+        for f in folded:
+            for i, c in enumerate(cmd):
+                if c.lower() == ascii_char:
+                    yield cmd[:i] + f + cmd[i + 1:]
+            yield cmd.replace(ascii_char, f)
+
+def test_samples_match_patterns():
+    for cmd in SAMPLES:
+        for v in (cmd, cmd.upper(), cmd.replace(" ", "\t")):
+            assert DANGEROUS_PATTERNS.search(v), v
+
+def test_is_safe_rejects_every_match():
+    folded = 0
+    for cmd in SAMPLES:
+        for v in variants(cmd):
+            if DANGEROUS_PATTERNS.search(v):
+                assert not is_safe(v), v
+                folded += not v.isascii()
+    assert folded, "no IGNORECASE fold variant was exercised"
+
+def test_plain_commands_pass():
+    for cmd in ["nmap -sV -p 22 10.0.0.5", "curl -I -m 5 http://10.0.0.5", "whatweb 10.0.0.5"]:
+        assert is_safe(cmd), cmd
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"):
+            fn()
+    print("ok")